@@ -1,6 +1,7 @@
 #!/usr/bin/env drgn
 
 import argparse
+import re
 import sys
 
 import md
@@ -12,19 +13,31 @@ from drgn import container_of, cast, Object
 from drgn.helpers.linux import find_task, for_each_task
 from drgn.helpers.linux.list import list_for_each_entry
 
+_dmesg_cache = None
+
+def _get_dmesg():
+    # Run dmesg once rather than forking a shell and grep per filter
+    # (which also choked on quotes in the filter)
+    global _dmesg_cache
+    if _dmesg_cache is None:
+        _dmesg_cache = subprocess.check_output(["dmesg"], text=True)
+    return _dmesg_cache
+
 def dmesg_filter(filt):
-    p = subprocess.Popen(f"dmesg | grep '{filt}'", shell=True,
-                         stdout=subprocess.PIPE, text=True)
+    for line in _get_dmesg().splitlines():
+        if filt in line:
+            yield line.split("]", 1)[1].strip()
 
-    for line in p.stdout.readlines():
-        yield line.split("]", 1)[1].strip()
+# The comm itself may contain colons (kworker/u8:3), so anchor on the
+# trailing "blocked" and let the last colon delimit the PID
+_HUNG_RE = re.compile(r'INFO: task \S+:(\d+) blocked')
 
 def dmesg_find_hung():
     """Find task PIDs from dmesg hung task warnings"""
 
-    for line in dmesg_filter("INFO: task"):
-        line = line.split()
-        yield int(line[2].split(":")[-1])
+    # One C-level regex sweep over the whole buffer instead of
+    # splitting every matching line three times
+    return [int(pid) for pid in _HUNG_RE.findall(_get_dmesg())]
 
 def find_wbt_hung_bios(hung_rwb):
     """This does the same as the dmesg parser, but by examining kernel
@@ -45,16 +58,28 @@ def find_wbt_hung_bios(hung_rwb):
 
     return in_progress_bios
 
+_dev_name_cache = {}
+
+def _dev_name(bdev):
+    # The kobj name walk is several kcore reads deep; most bios sit on
+    # the same few devices, so cache by device address
+    addr = bdev.bd_device.value_()
+    name = _dev_name_cache.get(addr)
+    if name is None:
+        name = bdev.bd_device.kobj.name.string_().decode()
+        _dev_name_cache[addr] = name
+    return name
+
 def print_bio(b, indent=2):
     print(f"{' '*indent}Bio {b.value_():x} {int(b.bi_opf):x} " +
-          f"{b.bi_bdev.bd_device.kobj.name.string_().decode()}")
+          f"{_dev_name(b.bi_bdev)}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     args = parser.parse_args()
 
     try:
-        hung_rwbs = []
+        hung_rwbs = {}
         plugs = {}
 
         for tsk in for_each_task(prog):
@@ -66,23 +91,26 @@ if __name__ == "__main__":
                       f"{tsk.comm.string_().decode()}:{tsk.pid}")
                 rq = tsk.plug.mq_list
                 while rq:
+                    # One bulk read per request instead of a kcore
+                    # access per field
+                    rq_obj = rq[0].read_()
                     print(f"  Req {rq.value_():x}")
-                    print_bio(rq.bio, indent=4)
-                    rq = rq.rq_next
+                    print_bio(rq_obj.bio, indent=4)
+                    rq = rq_obj.rq_next
                 print()
 
         for tsk in dmesg_find_hung():
             task = find_task(prog, tsk)
             trace = prog.stack_trace(task)
 
-            if trace[4].name != "rq_qos_wait":
+            if len(trace) <= 4 or trace[4].name != "rq_qos_wait":
                 continue
             rwb = cast("struct wbt_wait_data *",
                        trace[4]["data"].private_data).rwb
-            if rwb not in hung_rwbs:
-                hung_rwbs.append(rwb)
+            # Key on the address so dedup doesn't compare drgn Objects
+            hung_rwbs.setdefault(rwb.value_(), rwb)
 
-        hung_rwb = list(hung_rwbs)[0]
+        hung_rwb = list(hung_rwbs.values())[0]
         print(f"Found hung rwb: {hung_rwb.value_():x} (of {len(hung_rwbs)})")
 
         hung_bios = find_wbt_hung_bios(hung_rwb)
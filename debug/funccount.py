@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import argparse
+import heapq
+import itertools
+import os
+import re
+import select
+import signal
+import subprocess as sp
+import sys
+import threading
+import time
+
+AVAIL_FUNCS = "/sys/kernel/debug/tracing/available_filter_functions"
+
+_avail_funcs_cache = None
+
+def _get_avail_funcs():
+    # The file runs to tens of thousands of lines; parse it once and
+    # share across instances, rereading only if the file changes
+    # (e.g. a module load)
+    global _avail_funcs_cache
+    mtime = os.stat(AVAIL_FUNCS).st_mtime
+    if _avail_funcs_cache is None or _avail_funcs_cache[0] != mtime:
+        text = open(AVAIL_FUNCS).read()
+        # First token only: module functions carry a " [module]" suffix
+        names = frozenset(line.split()[0] for line in text.splitlines())
+        _avail_funcs_cache = (mtime, text, names)
+    return _avail_funcs_cache[1], _avail_funcs_cache[2]
+
+class FunccountError(Exception):
+    pass
+
+class _Launcher:
+    """One shared daemon thread that fires delayed starts for every
+       Funccount instead of a timer thread per instance"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._seq = itertools.count()
+        self._heap = []
+        self._thr = None
+
+    def enqueue(self, deadline, fc):
+        with self._lock:
+            heapq.heappush(self._heap, (deadline, next(self._seq), fc))
+            if self._thr is None:
+                self._thr = threading.Thread(target=self._loop,
+                                             daemon=True)
+                self._thr.start()
+        self._wakeup.set()
+
+    def cancel(self, fc):
+        """Remove a pending entry; returns False if it already fired"""
+        with self._lock:
+            for i, ent in enumerate(self._heap):
+                if ent[2] is fc:
+                    self._heap[i] = self._heap[-1]
+                    self._heap.pop()
+                    heapq.heapify(self._heap)
+                    return True
+        return False
+
+    def _loop(self):
+        while True:
+            due = []
+            with self._lock:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[2])
+                timeout = self._heap[0][0] - now if self._heap else None
+            for fc in due:
+                fc._fire()
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+_launcher = _Launcher()
+
+class Funccount:
+    """Count hits on kernel functions with bcc's funccount tool.
+
+       start() kicks off the tool after an optional delay; stop()
+       interrupts it and returns a dict of per-function hit counts."""
+
+    def __init__(self, funcs, delay=0, executable="funccount"):
+        if isinstance(funcs, str):
+            funcs = funcs.split()
+        self.funcs = funcs
+        self._func_set = frozenset(f for f in funcs if "*" not in f)
+        wild = [f.replace("*", ".*") for f in funcs if "*" in f]
+        self._wild_re = re.compile("|".join(f"^{w}$" for w in wild)) \
+            if wild else None
+        self.delay = delay
+        self.cmd = [executable] + funcs
+        self.proc = None
+        self.counts = {}
+
+        avail_text, avail_names = _get_avail_funcs()
+        for func in funcs:
+            if "*" not in func:
+                if func not in avail_names:
+                    raise FunccountError(
+                        f"{func} is not a traceable function")
+                continue
+            # One multiline search over the whole file stays in C rather
+            # than matching each line from Python
+            r = re.compile("^" + func.replace("*", ".*") + "$",
+                           re.MULTILINE)
+            if not r.search(avail_text):
+                raise FunccountError(f"{func} is not a traceable function")
+
+        self._pidfd = None
+        self._queued = False
+        self._spawned = threading.Event()
+        self._spawn_err = None
+
+    def _run(self):
+        kwargs = {}
+        if sys.version_info >= (3, 10):
+            # Enlarge the kernel pipe so the tool never blocks on a
+            # full pipe before stop() drains it
+            kwargs["pipesize"] = 1 << 20
+        # An explicit 64K buffer coalesces the reads when the tool
+        # dumps thousands of lines at once
+        self.proc = sp.Popen(self.cmd, stdout=sp.PIPE, stderr=sp.PIPE,
+                             text=True, start_new_session=True,
+                             bufsize=1 << 16, **kwargs)
+        if hasattr(os, "pidfd_open"):
+            try:
+                self._pidfd = os.pidfd_open(self.proc.pid)
+            except OSError:
+                pass
+
+    def _fire(self):
+        try:
+            self._run()
+        except Exception as e:
+            # Don't let a failed spawn kill the shared launcher thread;
+            # stash the error for stop() to raise
+            self._spawn_err = e
+        finally:
+            self._spawned.set()
+
+    def start(self):
+        self._queued = True
+        _launcher.enqueue(time.monotonic() + self.delay, self)
+
+    def stop(self):
+        if self._queued and not _launcher.cancel(self):
+            # Already fired (or firing); wait for the spawn to settle
+            self._spawned.wait()
+
+        if self._spawn_err is not None:
+            raise FunccountError(
+                f"failed to start {self.cmd[0]}: {self._spawn_err}") \
+                from self._spawn_err
+
+        if self.proc is None:
+            return self.counts
+
+        # funccount dumps its counts on SIGINT
+        os.killpg(os.getpgid(self.proc.pid), signal.SIGINT)
+        if self._pidfd is not None:
+            # One poll on the pidfd replaces wait(timeout)'s internal
+            # sleep/retry machinery
+            r, _, _ = select.select([self._pidfd], [], [], 1)
+            if not r:
+                os.killpg(os.getpgid(self.proc.pid), signal.SIGKILL)
+            os.close(self._pidfd)
+            self.proc.wait()
+        else:
+            try:
+                self.proc.wait(timeout=1)
+            except sp.TimeoutExpired:
+                os.killpg(os.getpgid(self.proc.pid), signal.SIGKILL)
+                self.proc.wait()
+        out, _ = self.proc.communicate()
+
+        for line in out.splitlines():
+            line = line.split()
+            if not line:
+                continue
+            if (line[0] in self._func_set or
+                (self._wild_re and self._wild_re.match(line[0]))):
+                self.counts[line[0]] = int(line[-1])
+
+        return self.counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("funcs", nargs="+",
+                        help="kernel functions to count")
+    parser.add_argument("-d", "--delay", type=float, default=0,
+                        help="seconds to wait before counting")
+    parser.add_argument("-t", "--time", type=float, default=10,
+                        help="seconds to count for")
+    args = parser.parse_args()
+
+    fc = Funccount(args.funcs, delay=args.delay)
+    fc.start()
+    time.sleep(args.time)
+    for func, cnt in fc.stop().items():
+        print(f"{func}: {cnt}")
@@ -4,6 +4,7 @@ from drgn.helpers.linux.list import (hlist_for_each_entry, list_for_each_entry,
 from drgn import Object, sizeof
 
 import enum
+import functools
 
 MD_MAJOR = 9
 
@@ -35,39 +36,37 @@ def get_raid5_conf(mddev):
 
     return Object(mddev.prog_, "struct r5conf", address=mddev.private)
 
+PAGE_SIZE = 4096
+_NR_HASH = None
+
 def find_hashed_stripes(conf):
-    PAGE_SIZE = 4096
-    NR_HASH = PAGE_SIZE // sizeof(conf.stripe_hashtbl[0])
+    global _NR_HASH
+    if _NR_HASH is None:
+        _NR_HASH = PAGE_SIZE // sizeof(conf.stripe_hashtbl[0])
+
+    # Pull the whole hash table page out of kcore in one read instead of
+    # one access per bucket
+    tbl = Object(conf.prog_, f"struct hlist_head [{_NR_HASH}]",
+                 address=conf.stripe_hashtbl.value_()).read_()
 
     stripes = []
-    for i in range(NR_HASH):
-        for s in hlist_for_each_entry('struct stripe_head',
-                                      conf.stripe_hashtbl[i].address_of_(),
-                                      'hash'):
+    for i in range(_NR_HASH):
+        for s in hlist_for_each_entry('struct stripe_head', tbl[i], 'hash'):
             stripes.append(s)
 
     return stripes
 
-def stripe_in_list(list_head, stripe):
-    for s in list_for_each_entry("struct stripe_head", list_head, "lru"):
-        if s == stripe:
-            return True
-
-    return False
-
 NR_STRIPE_HASH_LOCKS=8
-def stripe_in_inactive_list(conf, stripe):
-    for i in range(NR_STRIPE_HASH_LOCKS):
-        if stripe_in_list(conf.inactive_list[i].address_of_(), stripe):
-            return True
-
-    return False
+def build_stripe_lru_index(conf):
+    """Walk each LRU list exactly once and map stripe address to the
+       name of the list holding it"""
+    index = {}
 
-def find_stripe_lru_list(conf, stripe):
-    if list_empty(stripe.lru.address_of_()):
-        return "none"
-    if stripe_in_inactive_list(conf, stripe):
-        return "inactive"
+    for i in range(NR_STRIPE_HASH_LOCKS):
+        for s in list_for_each_entry("struct stripe_head",
+                                     conf.inactive_list[i].address_of_(),
+                                     "lru"):
+            index[s.value_()] = "inactive"
 
     lists = {"handle_list": conf.handle_list,
              "loprio_list": conf.loprio_list,
@@ -76,10 +75,20 @@ def find_stripe_lru_list(conf, stripe):
              "bitmap_list": conf.bitmap_list}
 
     for name, list_head in lists.items():
-        if stripe_in_list(list_head.address_of_(), stripe):
-            return name
+        for s in list_for_each_entry("struct stripe_head",
+                                     list_head.address_of_(), "lru"):
+            index[s.value_()] = name
+
+    return index
 
-    return "unknown"
+def find_stripe_lru_list(conf, stripe, lru_index=None):
+    if list_empty(stripe.lru.address_of_()):
+        return "none"
+
+    if lru_index is None:
+        lru_index = build_stripe_lru_index(conf)
+
+    return lru_index.get(stripe.value_(), "unknown")
 
 class Raid5StripeState(enum.IntEnum):
     STRIPE_ACTIVE = 0
@@ -140,40 +149,59 @@ class Raid5DevFlags(enum.IntEnum):
     R5_InJournal = enum.auto()
     R5_OrigPageUPTDODATE = enum.auto()
 
+_STATE_BY_BIT = {1 << s.value: s for s in Raid5StripeState}
+_DEV_FLAG_BY_BIT = {1 << f.value: f for f in Raid5DevFlags}
+
+def _scan_bits(val, by_bit):
+    # Peel off the lowest set bit each iteration so only set bits cost
+    # anything
+    out = []
+    while val:
+        lb = val & -val
+        b = by_bit.get(lb)
+        if b is not None:
+            out.append(b)
+        val ^= lb
+    return out
+
+# The same handful of state/flag combinations repeat across every
+# stripe in a dump, so memoize the expansion on the raw value
+@functools.lru_cache(maxsize=None)
 def stripe_states(state):
-    states = []
-    for s in Raid5StripeState:
-        if (1 << s.value) & state:
-            states.append(s)
-    return states
+    return _scan_bits(int(state), _STATE_BY_BIT)
 
+@functools.lru_cache(maxsize=None)
 def stripe_rdev_flags(flg):
-    flags = []
-    for f in Raid5DevFlags:
-        if (1 << f.value) & flg:
-            flags.append(f)
-    return flags
+    return _scan_bits(int(flg), _DEV_FLAG_BY_BIT)
+
+def print_stripe_info(conf, stripe, lru_index=None):
+    # One bulk read of the stripe_head (and one of its dev array, which
+    # is a flexible array member so read_() won't pick it up) serves all
+    # the field accesses below from local memory
+    cached = stripe.read_()
+    disks = int(cached.disks)
+    devs = Object(stripe.prog_, f"struct r5dev [{disks}]",
+                  address=stripe.dev.address_).read_()
 
-def print_stripe_info(conf, stripe):
     print("Stripe Info:")
     print(f"  Address:      {stripe.value_():x}")
-    print(f"  Sector:       {int(stripe.sector)}")
-    print(f"  State:        {hex(stripe.state)}")
-    for s in stripe_states(stripe.state):
+    print(f"  Sector:       {int(cached.sector)}")
+    print(f"  State:        {hex(cached.state)}")
+    for s in stripe_states(int(cached.state)):
         print(f"                {s.name}")
 
-    lru_list = find_stripe_lru_list(conf, stripe)
+    lru_list = find_stripe_lru_list(conf, stripe, lru_index)
     print(f"  LRU List:     {lru_list}")
 
-    for i in range(stripe.disks):
-        if i == stripe.pd_idx:
+    for i in range(disks):
+        if i == cached.pd_idx:
             typ = "P"
-        elif i == stripe.qd_idx:
+        elif i == cached.qd_idx:
             typ = "Q"
         else:
             typ = "D"
         print(f"  Disk:	    {i} ({typ})")
-        print(f"    Sector:    {int(stripe.dev[i].sector)}")
-        print(f"    Flags:     {hex(stripe.dev[i].flags)}")
-        for f in stripe_rdev_flags(stripe.dev[i].flags):
+        print(f"    Sector:    {int(devs[i].sector)}")
+        print(f"    Flags:     {hex(devs[i].flags)}")
+        for f in stripe_rdev_flags(int(devs[i].flags)):
             print(f"            {f.name}")
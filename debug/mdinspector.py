@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import mmap
 import os
 import pathlib
 import struct
@@ -14,6 +15,17 @@ SZ_1K = 1024
 SZ_4K = 4 * SZ_1K
 SZ_8K = 8 * SZ_4K
 
+# Fixed header layout for v1.x superblocks, offsets 0x00-0xe0; pad bytes
+# (Nx) cover the magic and the reserved gaps between areas
+_SB_HDR = struct.Struct('<4x L l 4x 16s 32s Q l L Q L L L L Q L L L 4x'
+                        'Q Q Q Q L L 16s l 4x Q Q Q L L')
+
+_FEATURE_MASKS = {'bitmap_used':          1,
+                  'recovery_in_progress': 2,
+                  'reshape_in_progress':  4,
+}
+_DEVFLAG_MASKS = {'write_mostly_1': 1}
+
 # MD Superblock layout from: https://raid.wiki.kernel.org/index.php/RAID_superblock_formats
 class MDBlkDev:
     path: pathlib.Path
@@ -59,120 +71,102 @@ class MDBlkDev:
         self.sb_off = 0
         self.sb_ver = '1.1'
 
-        if self._rd_ulong(0) != MDRAID_MAGIC:
+        if self._rd_magic() != MDRAID_MAGIC:
             self.sb_off = SZ_4K
             self.sb_ver = '1.2'
 
-        if self._rd_ulong(0) != MDRAID_MAGIC:
+        if self._rd_magic() != MDRAID_MAGIC:
             self.sb_off = (self.sz & ~(SZ_4K-1)) - SZ_8K
             self.sb_ver = '1.0'
 
-        if self._rd_ulong(0) != MDRAID_MAGIC:
+        if self._rd_magic() != MDRAID_MAGIC:
             raise NotImplementedError('Only md raid superblock versions 1.0, 1.1, and 1.2 are supported by this tool')
 
-        self.sb_major = self._rd_ulong(0x04)
-        self.sb_feature_map = self._rd_longbits(0x08, ['bitmap_used', 'recovery_in_progress', 'reshape_in_progress'])
-        self.sb_set_uuid = os.pread(self.fd, 16, self.sb_off + 0x10)
-        self.sb_set_name = os.pread(self.fd, 32, self.sb_off + 0x20).decode()
-        self.sb_ctime = self._rd_time(0x40)
-        self.sb_level = self._rd_long(0x48)
-        self.sb_layout = self._rd_ulong(0x4c)
-        self.sb_size = self._rd_ulonglong(0x50)
-        self.sb_chunksize = self._rd_ulong(0x58)
-        self.sb_raid_disks = self._rd_ulong(0x5c)
-        self.sb_bitmap_offset = self._rd_ulong(0x60)
-        self.sb_new_level = self._rd_ulong(0x64)
-        self.sb_reshape_pos = self._rd_ulonglong(0x68)
-        self.sb_delta_disks = self._rd_ulong(0x70)
-        self.sb_new_layout = self._rd_ulong(0x74)
-        self.sb_new_chunk = self._rd_ulong(0x78)
-        self.sb_data_offset = self._rd_ulonglong(0x80)
-        self.sb_data_size = self._rd_ulonglong(0x88)
-        self.sb_super_offset = self._rd_ulonglong(0x90)
-        self.sb_recovery_offset = self._rd_ulonglong(0x98)
-        self.sb_dev_number = self._rd_ulong(0xa0)
-        self.sb_cnt_corrected_read = self._rd_ulong(0xa4)
-        self.sb_device_uuid = os.pread(self.fd, 16, self.sb_off + 0xa8)
-        self.sb_devflags = self._rd_longbits(0xb8, ['write_mostly_1'])
-        self.sb_utime = self._rd_time(0xc0) 
-        self.sb_events = self._rd_ulonglong(0xc8)
-        self.sb_resync_offset = self._rd_ulonglong(0xd0)
-        self.sb_csum = self._rd_ulong(0xd8)
-        self.sb_max_dev = self._rd_ulong(0xdc)
-        # TODO: better check on sb_raid_disks
-        self.sb_disk_roles = []
-        for i in range(min(self.sb_raid_disks, 128)):
-            self.sb_disk_roles.append(self._rd_ushort(0x100 + 2 * i))
-
-    def _rd_ushort(self, pos: int) -> int:
-        return struct.unpack('<H', os.pread(self.fd, 2, self.sb_off + pos))[0]
+        # Map the superblock once and parse the fields straight out of the
+        # mapping rather than issuing a tiny pread per field
+        page_off = self.sb_off & ~(mmap.PAGESIZE - 1)
+        self._mm = mmap.mmap(self.fd, self.sb_off - page_off + SZ_4K,
+                             prot=mmap.PROT_READ, offset=page_off)
+        self._sb_buf = memoryview(self._mm)[self.sb_off - page_off:]
+
+        (self.sb_major, feature_map, self.sb_set_uuid, set_name, ctime,
+         self.sb_level, self.sb_layout, self.sb_size, self.sb_chunksize,
+         self.sb_raid_disks, self.sb_bitmap_offset, self.sb_new_level,
+         self.sb_reshape_pos, self.sb_delta_disks, self.sb_new_layout,
+         self.sb_new_chunk, self.sb_data_offset, self.sb_data_size,
+         self.sb_super_offset, self.sb_recovery_offset, self.sb_dev_number,
+         self.sb_cnt_corrected_read, self.sb_device_uuid, devflags, utime,
+         self.sb_events, self.sb_resync_offset, self.sb_csum,
+         self.sb_max_dev) = _SB_HDR.unpack_from(self._sb_buf, 0)
+
+        self.sb_feature_map = self._longbits(feature_map, _FEATURE_MASKS)
+        self.sb_set_name = set_name.decode()
+        self.sb_ctime = self._decode_time(ctime)
+        self.sb_devflags = self._longbits(devflags, _DEVFLAG_MASKS)
+        self.sb_utime = self._decode_time(utime)
 
-    def _rd_ulong(self, pos: int) -> int:
-        return struct.unpack('<L', os.pread(self.fd, 4, self.sb_off + pos))[0]
-
-    def _rd_long(self, pos: int) -> int:
-        return struct.unpack('<l', os.pread(self.fd, 4, self.sb_off + pos))[0]
-
-    def _rd_longbits(self, pos: int, values: t.List[str]) -> t.Dict[str, bool]:
-        ret: t.Dict[str, bool] = {}
-
-        val = self._rd_long(pos)
-        for i in range(len(values)):
-            ret[values[i]] = bool((1 << i) & val)
+        # TODO: better check on sb_raid_disks
+        nroles = min(self.sb_raid_disks, 128)
+        self.sb_disk_roles = [r for r, in
+                              struct.iter_unpack('<H',
+                                  self._sb_buf[0x100:0x100 + 2 * nroles])]
 
-        return ret
+    def _rd_magic(self) -> int:
+        return struct.unpack('<L', os.pread(self.fd, 4, self.sb_off))[0]
 
-    def _rd_ulonglong(self, pos: int) -> int:
-        return struct.unpack('<Q', os.pread(self.fd, 8, self.sb_off + pos))[0]
+    @staticmethod
+    def _longbits(val: int, masks: t.Dict[str, int]) -> t.Dict[str, bool]:
+        return {name: bool(val & mask) for name, mask in masks.items()}
 
-    def _rd_time(self, pos: int) -> float:
-        ival = self._rd_ulonglong(pos)
+    @staticmethod
+    def _decode_time(ival: int) -> float:
         return (ival >> 40) + (ival & ((1 << 24) - 1)) * 1e-6
 
     def read_data(self, pos: int, count: int) -> bytes:
         return os.pread(self.fd, count, self.sb_data_offset * 512 + pos)
 
     def __str__(self) -> str:
-        ret = ''
-        ret += f"sb v{self.sb_ver}\n"
-        ret += "  sb id area\n"
-        ret += f"    major version: {self.sb_major}\n"
-        ret += f"    feature map: {self.sb_feature_map}\n"
-        ret += "  per-array id & cfg\n"
-        ret += f"    set_uuid: {self.sb_set_uuid.hex()}\n"
-        ret += f"    set_name: {self.sb_set_name}\n"
-        ret += f"    ctime: {self.sb_ctime:.6f} s\n"
-        ret += f"    level: {self.sb_level}\n"
-        ret += f"    layout: 0x{self.sb_layout:x}\n"
-        ret += f"    size: {self.sb_size}\n"
-        ret += f"    chunksize: {self.sb_chunksize}\n"
-        ret += f"    raid_disks: {self.sb_raid_disks}\n"
-        ret += f"    bitmap_offset: {self.sb_bitmap_offset}\n"
-        ret += "  reshape area\n"
-        ret += f"    new_level: {self.sb_new_level}\n"
-        ret += f"    reshape_pos: {self.sb_reshape_pos}\n"
-        ret += f"    delta_disks: {self.sb_delta_disks}\n"
-        ret += f"    new_layout: 0x{self.sb_new_layout:x}\n"
-        ret += f"    new_chunk: {self.sb_new_chunk}\n"
-        ret += "  this cmp dev info area\n"
-        ret += f"    data_offset: {self.sb_data_offset}\n"
-        ret += f"    data_size: {self.sb_data_size}\n"
-        ret += f"    super_offset: {self.sb_super_offset}\n"
-        ret += f"    recovery_offset: {self.sb_recovery_offset}\n"
-        ret += f"    dev_number: {self.sb_dev_number}\n"
-        ret += f"    cnt_corrected_read: {self.sb_cnt_corrected_read}\n"
-        ret += f"    device_uuid: {self.sb_device_uuid.hex()}\n"
-        ret += f"    devflags: {self.sb_devflags}\n"
-        ret += "  array-state info area\n"
-        ret += f"    utime: {self.sb_utime:.6f} s\n"
-        ret += f"    events: {self.sb_events}\n"
-        ret += f"    resync_offset: {self.sb_resync_offset}\n"
-        ret += f"    sb_csum: 0x{self.sb_csum:x}\n"
-        ret += f"    max_dev: {self.sb_max_dev}\n"
-        ret += " device-roles area (0xffff = spare, 0xfffe = faulty)\n"
-        for i in range(len(self.sb_disk_roles)):
-            ret += f"    dev_role[{i}]: 0x{self.sb_disk_roles[i]:x}\n"
-        return ret
+        parts = [
+            f"sb v{self.sb_ver}",
+            "  sb id area",
+            f"    major version: {self.sb_major}",
+            f"    feature map: {self.sb_feature_map}",
+            "  per-array id & cfg",
+            f"    set_uuid: {self.sb_set_uuid.hex()}",
+            f"    set_name: {self.sb_set_name}",
+            f"    ctime: {self.sb_ctime:.6f} s",
+            f"    level: {self.sb_level}",
+            f"    layout: 0x{self.sb_layout:x}",
+            f"    size: {self.sb_size}",
+            f"    chunksize: {self.sb_chunksize}",
+            f"    raid_disks: {self.sb_raid_disks}",
+            f"    bitmap_offset: {self.sb_bitmap_offset}",
+            "  reshape area",
+            f"    new_level: {self.sb_new_level}",
+            f"    reshape_pos: {self.sb_reshape_pos}",
+            f"    delta_disks: {self.sb_delta_disks}",
+            f"    new_layout: 0x{self.sb_new_layout:x}",
+            f"    new_chunk: {self.sb_new_chunk}",
+            "  this cmp dev info area",
+            f"    data_offset: {self.sb_data_offset}",
+            f"    data_size: {self.sb_data_size}",
+            f"    super_offset: {self.sb_super_offset}",
+            f"    recovery_offset: {self.sb_recovery_offset}",
+            f"    dev_number: {self.sb_dev_number}",
+            f"    cnt_corrected_read: {self.sb_cnt_corrected_read}",
+            f"    device_uuid: {self.sb_device_uuid.hex()}",
+            f"    devflags: {self.sb_devflags}",
+            "  array-state info area",
+            f"    utime: {self.sb_utime:.6f} s",
+            f"    events: {self.sb_events}",
+            f"    resync_offset: {self.sb_resync_offset}",
+            f"    sb_csum: 0x{self.sb_csum:x}",
+            f"    max_dev: {self.sb_max_dev}",
+            " device-roles area (0xffff = spare, 0xfffe = faulty)",
+        ]
+        parts.extend(f"    dev_role[{i}]: 0x{r:x}"
+                     for i, r in enumerate(self.sb_disk_roles))
+        return '\n'.join(parts) + '\n'
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('MD array block device inspection utility')
@@ -197,10 +191,29 @@ if __name__ == '__main__':
 
         data_len = min(data_len, md_dev.sb_data_size * 512 - data_pos)
 
+        # sendfile copies straight from the disk to stdout in the kernel,
+        # avoiding a user-space bounce buffer for each chunk; fall back
+        # to pread/write for targets it can't handle (e.g. a terminal)
+        sys.stdout.flush()
+        out_fd = sys.stdout.fileno()
+        use_sendfile = True
         while data_len:
-            data = md_dev.read_data(data_pos, min(1 << 20, data_len))
-            sys.stdout.buffer.write(data)
-            data_len -= len(data)
-            data_pos += len(data)
+            chunk = min(1 << 20, data_len)
+            if use_sendfile:
+                try:
+                    sent = os.sendfile(out_fd, md_dev.fd,
+                                       md_dev.sb_data_offset * 512 + data_pos,
+                                       chunk)
+                except OSError:
+                    use_sendfile = False
+                    continue
+                if sent == 0:
+                    break
+            else:
+                data = md_dev.read_data(data_pos, chunk)
+                sys.stdout.buffer.write(data)
+                sent = len(data)
+            data_len -= sent
+            data_pos += sent
     else:
         print(md_dev, end='')
@@ -3,6 +3,8 @@
 import argparse
 import sys
 
+from collections import Counter
+
 import md
 
 if __name__ == "__main__":
@@ -24,35 +26,43 @@ if __name__ == "__main__":
         print()
 
         stripes = md.find_hashed_stripes(conf)
+        lru_index = md.build_stripe_lru_index(conf)
         print(f"Hashed Stripes: {len(stripes)}")
 
-        state_map = {}
+        # Classify states and find non-LRU stripes in one pass so each
+        # stripe's fields only get fetched from kcore once
+        state_counts = Counter()
+        first_non_lru = None
+        non_lru_count = 0
         for s in stripes:
-            state_map.setdefault(hex(s.state), []).append(s)
+            cached = s.read_()
+            state_counts[int(cached.state)] += 1
+            # lru is empty when next points back at itself; computing the
+            # member address doesn't touch kcore
+            if cached.lru.next.value_() == s.lru.address_of_().value_():
+                non_lru_count += 1
+                if first_non_lru is None:
+                    first_non_lru = s
 
-        for state, lst in state_map.items():
-            print(f"  -- State: {state} Count: {len(lst)}")
+        for state, cnt in state_counts.items():
+            print(f"  -- State: {hex(state)} Count: {cnt}")
 
         if args.stripe:
             for s in stripes:
                 if s.sector == args.stripe:
                     print()
                     print("Requested ", end="")
-                    md.print_stripe_info(conf, s)
+                    md.print_stripe_info(conf, s, lru_index)
                     print()
                     break
             else:
                 print("WARNING: Requested stripe not in hash table!")
                 print()
 
-        non_lru_stripes = []
-        for s in stripes:
-            if md.list_empty(s.lru.address_of_()):
-                non_lru_stripes.append(s)
-        print(f"Hashed Stripes not in LRU: {len(non_lru_stripes)}")
+        print(f"Hashed Stripes not in LRU: {non_lru_count}")
 
-        if non_lru_stripes:
-            md.print_stripe_info(conf, non_lru_stripes[0])
+        if first_non_lru is not None:
+            md.print_stripe_info(conf, first_non_lru, lru_index)
 
     except md.MDException as e:
         print(e)
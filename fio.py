@@ -3,6 +3,7 @@
 
 import json
 import psutil
+import shutil
 import subprocess as sp
 
 class FIO:
@@ -28,7 +29,9 @@ class FIO:
         }
         self.cpu = cpu
         self.args.update(kargs)
-        self.executable = executable
+        # Resolve the PATH walk once; an absolute path is also one of
+        # the conditions for subprocess's posix_spawn fast path
+        self.executable = shutil.which(executable) or executable
 
     def gen_options(self):
         return [f"--{key}={val}" for key, val in self.args.items()]
@@ -45,13 +48,18 @@ class FIO:
             if self.cpu:
                 psutil.cpu_times_percent()
 
-            run_result = sp.check_output(run_cmd, encoding="utf-8",
-                                         stderr=sp.PIPE)
+            # A resolved executable path, close_fds=False and stdin from
+            # DEVNULL are what lets subprocess take its posix_spawn fast
+            # path instead of forking the whole interpreter for a
+            # long-running fio child
+            run_result = sp.run(run_cmd, capture_output=True, text=True,
+                                check=True, stdin=sp.DEVNULL,
+                                close_fds=False)
 
             if self.cpu:
                 test_data["cpu"] = psutil.cpu_times_percent()
 
-            test_data["result"] = json.loads(run_result)
+            test_data["result"] = json.loads(run_result.stdout)
         except sp.CalledProcessError as err:
             test_data["err"] = {
                 "stdout": err.stdout.split("\n"),
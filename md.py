@@ -1,26 +1,79 @@
 #!/usr/bin/env python3
 
 import argparse
+import ctypes
+import fcntl
+import mmap
 import os
-import pathlib
 import re
+import select
+import shutil
+import struct
 import subprocess
 import sys
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
+BLKZEROOUT = 0x127f
+
+# Resolve helper binaries once so each exec skips the PATH search, and
+# hand children a minimal env with fd inheritance left alone
+_MODPROBE = shutil.which("modprobe") or "modprobe"
+_LOSETUP = shutil.which("losetup") or "losetup"
+_SP_KWARGS = {"close_fds": False,
+              "env": {"PATH": "/usr/sbin:/sbin:/usr/bin:/bin"},
+}
+
+IN_DELETE = 0x200
+IN_MOVED_FROM = 0x40
+
+def _wait_for_unlink(path, timeout=5.0):
+    """Sleep on an inotify watch until path disappears. Returns False
+       if inotify isn't usable (or the wait timed out) so the caller
+       can fall back to polling."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        ifd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return False
+    if ifd < 0:
+        return False
+
+    try:
+        dirname = os.path.dirname(path) or "/"
+        wd = libc.inotify_add_watch(ifd, dirname.encode(),
+                                    IN_DELETE | IN_MOVED_FROM)
+        if wd < 0:
+            return False
+
+        deadline = time.monotonic() + timeout
+        # Check existence only after the watch is armed to avoid losing
+        # the event to a race
+        while os.path.exists(path):
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            r, _, _ = select.select([ifd], [], [], left)
+            if r:
+                os.read(ifd, 4096)
+        return True
+    finally:
+        os.close(ifd)
+
 class _EnvironmentArgMixin:
     _is_mutex_grp = False
     _env_found = None
+    _env = None
+
+    _TRUE_FIRST = frozenset("yt")
 
     def to_bool(self, x):
         if isinstance(x, bool):
             return x
-        if isinstance(x, str):
+        if isinstance(x, str) and x:
             x = x.lower()
-            if x.startswith("y") or x.startswith("t") or x == "1":
-                return True
-            if x.startswith("n") or x.startswith("f") or x == "0":
-                return False
+            return x[0] in self._TRUE_FIRST or x == "1"
         return False
 
     def add_argument(self, *args, **kwargs):
@@ -31,14 +84,15 @@ class _EnvironmentArgMixin:
             return action
 
         env = action.dest.upper()
-        if self._is_mutex_grp and os.environ.get(env, None):
+        envdict = self._env if self._env is not None else os.environ
+        if self._is_mutex_grp and envdict.get(env):
             if self._env_found is not None:
                 print(f"environment variable {env} not allowed with variable {self._env_found}",
                       file=sys.stderr)
                 sys.exit(2)
             self._env_found = env
 
-        envval = os.environ.get(env, action.default)
+        envval = envdict.get(env, action.default)
         if action_type in ("store_true", "store_false"):
             envval = self.to_bool(envval)
         nargs = kwargs.get("nargs", None)
@@ -52,10 +106,18 @@ class _EnvironmentArgMixin:
 
         return action
 
+    _mixin_cache = {}
+
     def _mixin_group(self, grp):
+        # Synthesize one subclass per underlying group type rather than
+        # a fresh class object for every group
         orig_typ = type(grp)
-        grp.__class__ = type("_Env" + orig_typ.__name__,
-                             (_EnvironmentArgMixin, orig_typ), {})
+        cls = self._mixin_cache.get(orig_typ)
+        if cls is None:
+            cls = type("_Env" + orig_typ.__name__,
+                       (_EnvironmentArgMixin, orig_typ), {})
+            self._mixin_cache[orig_typ] = cls
+        grp.__class__ = cls
         return grp
 
     def add_argument_group(self, *args, **kwargs):
@@ -78,27 +140,53 @@ class _EnvironmentArgumentParser(_EnvironmentArgMixin,
 
     def __init__(self, *, formatter_class=_CustomHelpFormatter,
                  **kwargs):
+        # Snapshot the environment once per parser rather than scanning
+        # os.environ for every option added
+        _EnvironmentArgMixin._env = dict(os.environ)
         super().__init__(formatter_class=formatter_class, **kwargs)
 
-class MDArgumentParser(_EnvironmentArgumentParser):
-    _UNITS = {"B": 1,
-              "K": 1 << 10,
-              "M": 1 << 20,
-              "G": 1 << 30,
-              "T": 1 << 40,
-    }
+_SUFFIX_RE = re.compile(r'(\d+)([KMGTB]?)B?\Z', re.IGNORECASE)
+_UNIT_SHIFT = {"": 0,
+               "B": 0,
+               "K": 10,
+               "M": 20,
+               "G": 30,
+               "T": 40,
+}
 
+class MDArgumentParser(_EnvironmentArgumentParser):
     @classmethod
     def _suffix_parse(cls, val):
-        m = re.match(r'^(\d+)([KMGTB]?)B?$', val.upper())
+        m = _SUFFIX_RE.match(val)
         if m:
             number, unit = m.groups()
-            return int(number) * cls._UNITS[unit]
+            # Only the 0-1 char unit needs case folding, not the value
+            return int(number) << _UNIT_SHIFT[unit.upper()]
         raise TypeError("Not a valid size")
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-
+        self._md_grp = None
+
+    @property
+    def md_grp(self):
+        if self._md_grp is None:
+            self._build_md_group()
+        return self._md_grp
+
+    def parse_known_args(self, *args, **kwargs):
+        if self._md_grp is None:
+            self._build_md_group()
+        return super().parse_known_args(*args, **kwargs)
+
+    def format_help(self):
+        if self._md_grp is None:
+            self._build_md_group()
+        return super().format_help()
+
+    def _build_md_group(self):
+        # Registering ~15 options costs an env lookup each, so defer it
+        # until the parser is actually used
         grp = self.add_argument_group("MD Array Options")
         grp.add_argument("-l", "--level", type=int, default=5,
                          help="raid level")
@@ -135,7 +223,7 @@ class MDArgumentParser(_EnvironmentArgumentParser):
                          help="size used from each disk")
         grp.add_argument("--mdadm", help="mdadm executable to use")
 
-        self.md_grp = grp
+        self._md_grp = grp
 
 class MDInvalidArgumentError(Exception):
     pass
@@ -145,6 +233,17 @@ class MDInstance:
     # constituent disks get zeroed. 5MB seems like a high bar.
     MAX_SUPERBLOCK_SZ = 5 << 20
 
+    _mdadm_cache = {}
+
+    @classmethod
+    def _resolve_mdadm(cls, mdadm):
+        # Resolve the PATH walk once per executable name rather than
+        # inside execvp on every mdadm invocation
+        name = mdadm or "mdadm"
+        if name not in cls._mdadm_cache:
+            cls._mdadm_cache[name] = shutil.which(name) or name
+        return cls._mdadm_cache[name]
+
     @classmethod
     def create_from_parsed_args(cls, args):
         return cls(level=args.level,
@@ -162,8 +261,25 @@ class MDInstance:
                    cache_size=args.cache_size,
                    mdadm=args.mdadm)
 
+    # Environment variables the parser's options respond to
+    # (action.dest.upper() for each MD group option)
+    _ENV_KEYS = frozenset((
+        "LEVEL", "CHUNK_SIZE", "DISKS", "DISK_TYPE", "DEVS",
+        "ASSUME_CLEAN", "FORCE", "ZERO_FIRST", "RUN", "POLICY",
+        "QUIET", "THREAD_CNT", "CACHE_SIZE", "SIZE", "MDADM"))
+
     @classmethod
     def create_from_args(cls, args=None):
+        # With no CLI arguments and none of the parser's environment
+        # variables set, argparse would only hand back its defaults;
+        # skip building the parser entirely
+        if (args is None and len(sys.argv) == 1 and
+                cls._ENV_KEYS.isdisjoint(os.environ)):
+            # Must mirror the parser defaults where they differ from
+            # the constructor's: --disks defaults to 3 and --force is
+            # a store_true, so it is False unless given
+            return cls(ndisks=3, force=False)
+
         md_parser = MDArgumentParser()
         args = md_parser.parse_args(args)
         return cls.create_from_parsed_args(args)
@@ -173,7 +289,8 @@ class MDInstance:
                  assume_clean=True, force=True, run=False, policy="resync",
                  quiet=False, thread_cnt=4, cache_size=8192, mdadm=None):
         self.md_dev = f"/dev/{md}"
-        self._sysfs = pathlib.Path("/sys/block") / md / "md"
+        self._sysfs = f"/sys/block/{md}/md"
+        self._sysfs_fd = None
 
         self.level = level
         self.ndisks = ndisks
@@ -187,7 +304,9 @@ class MDInstance:
         self.thread_cnt = thread_cnt
         self.cache_size = cache_size
         self._size_to_zero = None
-        self.mdadm = mdadm or "mdadm"
+        self._cached_level = None
+        self._cached_num_disks = None
+        self.mdadm = self._resolve_mdadm(mdadm)
 
         if (devs is None and disk_type == 'dev') or ndisks == 0:
             raise MDInvalidArgumentError("No disks specified for an array")
@@ -204,7 +323,8 @@ class MDInstance:
         if self.disk_type == 'ram':
             if devs:
                 raise MDInvalidArgumentError("Must not specify both devs and ram_disks")
-            subprocess.check_call(["modprobe", "brd", "rd_size=131072"])
+            subprocess.check_call([_MODPROBE, "brd", "rd_size=131072"],
+                                  **_SP_KWARGS)
             self.devs = [f"/dev/ram{i}" for i in range(ndisks)]
         elif self.disk_type == 'loopback':
             if devs:
@@ -227,32 +347,89 @@ class MDInstance:
 
     def wait(self):
         subprocess.call([self.mdadm, "--wait", self.md_dev, "--quiet"],
-                        stderr=subprocess.DEVNULL)
+                        stderr=subprocess.DEVNULL, **_SP_KWARGS)
+
+    def _close_sysfs_fd(self):
+        if self._sysfs_fd is not None:
+            os.close(self._sysfs_fd)
+            self._sysfs_fd = None
+
+    def _sysfs_attr_open(self, name, flags):
+        # Keep one fd on the md sysfs dir and open attributes relative
+        # to it instead of re-walking /sys for every access
+        if self._sysfs_fd is None:
+            self._sysfs_fd = os.open(self._sysfs,
+                                     os.O_RDONLY | os.O_DIRECTORY)
+        return os.open(name, flags, dir_fd=self._sysfs_fd)
+
+    def _sysfs_read(self, name):
+        fd = self._sysfs_attr_open(name, os.O_RDONLY)
+        try:
+            return os.read(fd, 4096).decode().strip()
+        finally:
+            os.close(fd)
+
+    def _sysfs_write(self, name, val):
+        fd = self._sysfs_attr_open(name, os.O_WRONLY)
+        try:
+            os.write(fd, str(val).encode())
+        finally:
+            os.close(fd)
 
     def stop(self):
+        # The md sysfs dir goes away with the array
+        self._close_sysfs_fd()
         subprocess.call([self.mdadm, "--stop", self.md_dev, "--quiet"],
-                        stderr=subprocess.DEVNULL)
-        while pathlib.Path(self.md_dev).exists():
-            time.sleep(0.01)
+                        stderr=subprocess.DEVNULL, **_SP_KWARGS)
+        if not _wait_for_unlink(self.md_dev):
+            md_dev = self.md_dev
+            delay = 0.001
+            while True:
+                try:
+                    os.stat(md_dev)
+                except FileNotFoundError:
+                    break
+                time.sleep(delay)
+                # Back off so long stops don't burn wakeups
+                delay = min(delay * 2, 0.05)
+
+    @staticmethod
+    def _create_backing(backing, size):
+        # posix_fallocate sizes the file in one metadata operation
+        fd = os.open(backing, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        try:
+            os.posix_fallocate(fd, 0, size)
+        finally:
+            os.close(fd)
 
     def _create_loop_disk(self, i, size):
         dev = f"/dev/loop{i}"
         backing = f"/var/tmp/lodisk{i}"
-        subprocess.call(["losetup", "-d", dev], stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL)
-        open(backing, "w").close()
-        os.truncate(backing, size)
-        subprocess.check_call(["losetup", dev, backing])
+        # Only fork losetup -d when the device is actually attached;
+        # sysfs shows a backing_file for busy loop devices
+        if os.path.exists(f"/sys/block/loop{i}/loop/backing_file"):
+            subprocess.call([_LOSETUP, "-d", dev], stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, **_SP_KWARGS)
+        self._create_backing(backing, size)
+        subprocess.check_call([_LOSETUP, dev, backing], **_SP_KWARGS)
         return dev
 
     def _create_loop_disks(self, count, size):
-        ret = []
-
-        for i in range(count):
-            dev = self._create_loop_disk(i, size)
-            ret.append(dev)
-
-        return ret
+        # One detach-all replaces a losetup -d fork per device
+        subprocess.call([_LOSETUP, "-D"], stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL, **_SP_KWARGS)
+
+        def create(i):
+            dev = f"/dev/loop{i}"
+            self._create_backing(f"/var/tmp/lodisk{i}", size)
+            subprocess.check_call([_LOSETUP, dev, f"/var/tmp/lodisk{i}"],
+                                  **_SP_KWARGS)
+            return dev
+
+        # The kernel serializes the attaches internally, but the file
+        # creation and losetup startup overlap; map() keeps the ordering
+        with ThreadPoolExecutor(max_workers=min(count, 8)) as ex:
+            return list(ex.map(create, range(count)))
 
     def _stop_and_create_disks(self):
         self.wait()
@@ -263,6 +440,8 @@ class MDInstance:
 
     def setup(self):
         self._stop_and_create_disks()
+        self._cached_level = None
+        self._cached_num_disks = None
 
         mdadm_args = [self.mdadm, "--create", self.md_dev,
                       "--level", str(self.level),
@@ -273,39 +452,68 @@ class MDInstance:
         if self.policy == "bitmap":
             mdadm_args.append("--bitmap=internal")
         if self.policy == "journal":
-            mdadm_args += ["--write-journal", self.get_special_disk()]
-        if self.assume_clean:
-            mdadm_args.append("--assume-clean")
-        if self.force:
-            mdadm_args.append("--force")
-        if self.run:
-            mdadm_args.append("--run")
-        if self.quiet:
-            mdadm_args.append("--quiet")
+            mdadm_args.extend(("--write-journal", self.get_special_disk()))
+
+        # One in-place extend for the single-flag options instead of a
+        # list allocation per branch
+        mdadm_args.extend(flag for cond, flag in (
+            (self.assume_clean, "--assume-clean"),
+            (self.force, "--force"),
+            (self.run, "--run"),
+            (self.quiet, "--quiet")) if cond)
+
         if self.size is not None:
-            mdadm_args += ["--size", str(self.size >> 10)]
+            mdadm_args.extend(("--size", str(self.size >> 10)))
 
-        subprocess.check_call(mdadm_args + self.devs)
+        subprocess.check_call(mdadm_args + self.devs, **_SP_KWARGS)
 
         if self.thread_cnt is not None:
-            (self._sysfs / "group_thread_cnt").write_text(str(self.thread_cnt))
+            self._sysfs_write("group_thread_cnt", self.thread_cnt)
         if self.cache_size is not None and self.cache_size > 0:
-            (self._sysfs / "stripe_cache_size").write_text(str(self.cache_size))
+            self._sysfs_write("stripe_cache_size", self.cache_size)
 
     def get_level(self):
-        return (self._sysfs / "level").read_text().strip()
+        # Fixed between setup()/grow(), so one sysfs read serves all the
+        # calls tests make from their inner loops
+        if self._cached_level is None:
+            self._cached_level = self._sysfs_read("level")
+        return self._cached_level
 
     def get_num_disks(self):
-        return int((self._sysfs / "raid_disks").read_text().strip())
+        if self._cached_num_disks is None:
+            self._cached_num_disks = int(self._sysfs_read("raid_disks"))
+        return self._cached_num_disks
 
     def get_disks(self):
         return self.devs
 
+    _zero_buf = None
+
+    @classmethod
+    def _get_zero_buf(cls):
+        # mmap gives a page-aligned buffer as O_DIRECT requires, shared
+        # across all devices
+        if cls._zero_buf is None:
+            cls._zero_buf = mmap.mmap(-1, 1 << 20)
+        return cls._zero_buf
+
     def _zero_disk(self, dev):
-        subprocess.check_call(["dd", "if=/dev/zero", f"of={dev}",
-                               "bs=1M", f"count={self._size_to_zero}",
-                               "oflag=direct"],
-                              stderr=subprocess.DEVNULL)
+        size = self._size_to_zero << 20
+        fd = os.open(dev, os.O_WRONLY | os.O_DIRECT)
+        try:
+            try:
+                # Lets the block layer zero the range itself, which is a
+                # single WRITE_ZEROES command on devices supporting it
+                fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", 0, size))
+                return
+            except OSError:
+                pass
+
+            buf = self._get_zero_buf()
+            for off in range(0, size, len(buf)):
+                os.pwrite(fd, buf, off)
+        finally:
+            os.close(fd)
 
     def zero_all_disks(self, size_to_zero):
         self._stop_and_create_disks()
@@ -314,10 +522,12 @@ class MDInstance:
         count = (count + (1 << 20) - 1) >> 20
         self._size_to_zero = count
 
-        for dev in self.devs:
-            self._zero_disk(dev)
-        for dev in self.special_devs:
-            self._zero_disk(dev)
+        # The zeroing is I/O bound per device, so issue it to all
+        # devices at once
+        with ThreadPoolExecutor() as ex:
+            for _ in ex.map(self._zero_disk,
+                            self.devs + self.special_devs):
+                pass
 
     def _get_next_disk(self):
         if self.devs is None:
@@ -351,19 +561,21 @@ class MDInstance:
         self.devs.append(dev)
         n = self.get_num_disks()
         subprocess.check_call([self.mdadm, "--add", self.md_dev,
-                               "--quiet", dev])
+                               "--quiet", dev], **_SP_KWARGS)
         subprocess.check_call([self.mdadm, "--grow", "--raid-devices",
-                               str(n + 1), self.md_dev])
+                               str(n + 1), self.md_dev], **_SP_KWARGS)
+        self._cached_num_disks = None
         return n + 1
 
     def degrade(self, dev):
         self.wait()
+        # mdadm takes both operations in one invocation, saving a
+        # fork/exec and device reopen
         subprocess.check_call([self.mdadm, "--manage", self.md_dev, "--quiet",
-                               "--fail", dev])
-        subprocess.check_call([self.mdadm, "--manage", self.md_dev, "--quiet",
-                               "--remove", dev], stderr=subprocess.DEVNULL)
+                               "--fail", dev, "--remove", dev],
+                              stderr=subprocess.DEVNULL, **_SP_KWARGS)
 
     def recover(self, dev):
         subprocess.check_call([self.mdadm, "--manage", self.md_dev, "--quiet",
-                               "--add-spare", dev])
+                               "--add-spare", dev], **_SP_KWARGS)
         time.sleep(0.1)